@@ -47,6 +47,7 @@ WORKSPACE = {
     "target"            : "RELEASE",        # "DEBUG", "NOOPT", "RELEASE", "RELEASE DEBUG"
     "log_type"          : "PCD",            # "PCD", "LIBRARY", "FLASH", "DEPEX", "HASH", "BUILD_FLAGS", "FIXED_ADDRESS"
     "tmp_dir"           : os.path.abspath("_pug_"),
+    "shallow"           : True,             # fetch only the "signature" of each CODETREE repo, without history.
 }
 WORKSPACE.update({
     "conf_path"         : os.environ.get("CONF_PATH", WORKSPACE["tmp_dir"] + "/Conf"),
@@ -19,7 +19,7 @@ A front-end to build the UEFI driver(s) with only .C source files and a .PY as t
 Timothy Lin Jan/30/2019, BSD 3-Clause License.
 
 Prerequisites:
-1. Python 2.7.x or Python 3.7.x
+1. Python 3.7.x or later
 2. git 2.17.x
 
 Generic prerequisites for the UDK build:
@@ -29,8 +29,7 @@ Generic prerequisites for the UDK build:
 2. iasl (version 2018xxxx or later)
 3. GCC(Posix) or MSVC(Windows)
 4. build-essential uuid-dev (Posix)
-5. pip2 install future (Python 2.7.x)
-6. motc (Xcode)
+5. motc (Xcode)
 
 Installation hints for any Debian Based Linux:
 1. sudo apt update & sudo apt install nasm iasl build-essential uuid-dev
@@ -43,14 +42,14 @@ TODO:
 
 """
 
-from __future__ import print_function
-from __future__ import absolute_import
-
 import os
 import sys
+import json
 import time
+import shlex
+import hashlib
 import shutil
-import threading
+import functools
 import subprocess
 import multiprocessing
 
@@ -59,25 +58,32 @@ sys.dont_write_bytecode = True      # To inhibit the creation of .pyc file
 VERBOSE_LEVEL = 1
 UDKBUILD_MAKETOOL = 'nmake' if os.name == 'nt' else 'make'
 UDKBUILD_COMMAND_JOINTER = '&' if os.name == 'nt' else ';'
+WRITE_FILE_CHUNK = 64 * 1024
+BUILD_STAMP_FILE = '.pug_build_stamp'
+BASETOOLS_LOG_FILE = 'basetools.log'
 
 default_pug_signature = '#\n# Do not edit this file.\n# It is automatically created by PUG.\n#\n'
 
+INF_SECTIONS = [
+    'Sources', 'Packages', 'LibraryClasses', 'Protocols', 'Ppis',
+    'Guids', 'FeaturePcd', 'Pcd', 'BuildOptions', 'Depex', 'UserExtensions',
+]
+
+# a component's sections which override the platform's, in the DSC's Components.
+DSC_OVERRIDES = frozenset({"LibraryClasses", "PcdsFixedAtBuild"}) #, "BuildOptions"})
+DSC_BAR_SEPARATED = frozenset({"LibraryClasses", "PcdsFixedAtBuild"})
+
 try:
     import config
 except ImportError:
     print('Unable to load the configuration file, config.py.')
     raise
 
-def cdpopd(d=''):
-    """chdir | popd"""
-    if d:
-        cdpopd.pushd += [os.getcwd()]
-    else:
-        if cdpopd.pushd:
-            d = cdpopd.pushd.pop()
-    if d:
-        os.chdir(d)
-cdpopd.pushd = []
+@functools.lru_cache(maxsize=None)
+def _abspath(p):
+    """memoized os.path.abspath(). Pug never changes its working directory,
+    so a relative path always resolves the same way."""
+    return os.path.abspath(p)
 
 
 def abs_path(sub_dir, base_dir):
@@ -87,58 +93,92 @@ def abs_path(sub_dir, base_dir):
 
 def write_file(path, content, signature=''):
     """update a platform's dsc file content.
+    - content is a string or any iterable of lines, e.g. a generator.
     - create the folder when it does not exist.
-    - skip write attempt when the contents are identical"""
+    - skip write attempt when the file is unchanged since write_file.stamp
+      recorded it with the same content.
+    - skip write attempt when the contents are identical; the existing file
+      is read, chunk by chunk, only when its size matches the new content's."""
 
-    if isinstance(content, (list, tuple)):
+    if not isinstance(content, str):
         content = '\n'.join(content)
-    if signature:
-        content = signature + content
-    path_dir = os.path.dirname(path)
-    content0 = ''
-    if not os.path.exists(path_dir):
-        os.makedirs(path_dir)
-    else:
-        if os.path.exists(path):
-            with open(path, 'r') as pf:
-                content0 = pf.read()
-            if content0 == content:
-                return
+    content_bytes = (signature + content).encode('utf-8')
+    digest = hashlib.sha1(content_bytes).hexdigest()
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    try:
+        st = os.stat(path)
+        if write_file.stamp.get(path) == [st.st_mtime_ns, digest]:
+            return
+        if st.st_size == len(content_bytes):
+            view = memoryview(content_bytes)
+            with open(path, 'rb') as pf:
+                for offset in range(0, len(view), WRITE_FILE_CHUNK):
+                    if pf.read(WRITE_FILE_CHUNK) != view[offset:offset + WRITE_FILE_CHUNK]:
+                        break
+                else:
+                    write_file.stamp[path] = [st.st_mtime_ns, digest]
+                    return
+    except FileNotFoundError:
+        pass
+    with open(path, 'wb') as pf:
+        pf.write(content_bytes)
+    write_file.stamp[path] = [os.stat(path).st_mtime_ns, digest]
+write_file.stamp = {}
+
+
+def load_build_stamp(path):
+    """load write_file.stamp, {path: [mtime_ns, sha1]}, of the last run."""
+    try:
+        with open(path, 'r') as pf:
+            write_file.stamp = json.load(pf)
+    except (OSError, ValueError):
+        write_file.stamp = {}
+
+
+def save_build_stamp(path):
+    """save write_file.stamp for the next run."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
     with open(path, 'w') as pf:
-        pf.write(content)
+        json.dump(write_file.stamp, pf, indent=1, sort_keys=True)
 
 
 def conf_files(files, dest_conf_dir, verbose=False):
-    """Ref. BaseTools/BuildEnv for build_rule.txt , tools_def.txt and target.txt"""
-    dest_conf_dir = os.path.abspath(dest_conf_dir)
-    if not os.path.exists(dest_conf_dir):
-        os.makedirs(dest_conf_dir)
+    """Ref. BaseTools/BuildEnv for build_rule.txt , tools_def.txt and target.txt
+    - skip the copy when the destination is not older than its template."""
+    dest_conf_dir = _abspath(dest_conf_dir)
+    os.makedirs(dest_conf_dir, exist_ok=True)
     os.environ["CONF_PATH"] = dest_conf_dir
     src_conf_dir = os.path.join(os.environ.get('EDK_TOOLS_PATH', os.path.join(os.environ['WORKSPACE'], 'BaseTools')), 'Conf')
     for f in files:
         src_conf_path = os.path.join(src_conf_dir, '%s.template' % f)
         dest_conf_path = os.path.join(dest_conf_dir, '%s.txt' % f)
+        try:
+            if os.stat(src_conf_path).st_mtime <= os.stat(dest_conf_path).st_mtime:
+                continue
+        except FileNotFoundError:
+            pass
         if verbose:
             print('Copy %s\nTo   %s' % (src_conf_path, dest_conf_path))
         shutil.copyfile(src_conf_path, dest_conf_path)
 
 
 def gen_section(items, override=None, section='', sep='=', ident=0):
-    """generate a section's content"""
-    ret_list = []
+    """generate a section's content, line by line"""
     if section:
-        ret_list += ['\n%s[%s]' % (' '*ident*2, section)]
+        yield '\n%s[%s]' % (' '*ident*2, section)
     if items:
+        lead = ' '*(ident+1)*2
         if isinstance(items, (tuple, list)) or (override in {list, tuple}):
             for d in items:
                 if d:
                     if isinstance(d, (list, tuple)):
-                        ret_list += ['%s%s' % (' '*(ident+1)*2, sep.join(d))]
+                        yield '%s%s' % (lead, sep.join(d))
                     else:
-                        ret_list += ['%s%s' % (' '*(ident+1)*2, str(d))]
+                        yield '%s%s' % (lead, str(d))
         elif isinstance(items, dict):
-            ret_list += ['%s%s %s %s' % (' '*(ident+1)*2, str(d), sep, str(items[d])) for d in sorted(items) if d]
-    return ret_list
+            for d in sorted(items):
+                if d:
+                    yield '%s%s %s %s' % (lead, str(d), sep, str(items[d]))
 
 
 def gen_target_txt(target_txt):
@@ -152,76 +192,62 @@ def gen_target_txt(target_txt):
 
 def run(Command, WorkingDir='.', verbose=False):
     """A derivative of UDK's BaseTools/build/build.py::launch_command
+        Command is an argv list (or a command line string on Windows); it is
+        executed without an intermediate shell.
 
         returns
         [0] - error code
-        [1] - buffered stdout content
-        [2] - buffered stderr content
+        [1] - buffered stdout lines (empty when verbose)
+        [2] - buffered stderr lines (empty when verbose)
     """
-    stdout_buffer = []
-    stderr_buffer = []
-    def ReadMessage(From, To, ExitFlag):
-        """read message fro stream"""
-        while True:
-            Line = From.readline()
-            if Line:
-                To(Line.rstrip())
-            if not Line or ExitFlag.isSet():
-                break
+    print('%s' % (Command if isinstance(Command, str) else ' '.join(Command)))
 
-    def __logger(msg, buf):
-        if isinstance(msg, bytes):
-            msg = msg.decode('utf-8')
-        if verbose:
-            print('%s' % msg)
-        buf += [msg]
-
-    def logger_stdout(msg):
-        """print message from stdout"""
-        __logger(msg, stdout_buffer)
-
-    def logger_stderr(msg):
-        """print message from stderr"""
-        __logger(msg, stderr_buffer)
-
-    if isinstance(Command, (list, tuple)):
-        Command = ' '. join(Command)
-    print('%s' % Command)
-
-    WorkingDir = os.path.abspath(WorkingDir)
-    cdpopd(WorkingDir)
-    Proc = EndOfProcedure = StdOutThread = StdErrThread = None
-    _stdout = sys.stdout if verbose else subprocess.PIPE
-    _stderr = sys.stderr if verbose else subprocess.PIPE
+    WorkingDir = _abspath(WorkingDir)
     try:
-        Proc = subprocess.Popen(Command, stdout=_stdout, stderr=_stderr, env=os.environ, cwd=WorkingDir, bufsize=-1, shell=True)
-        if not verbose:
-            EndOfProcedure = threading.Event()
-            EndOfProcedure.clear()
-            if Proc.stdout:
-                StdOutThread = threading.Thread(target=ReadMessage, args=(Proc.stdout, logger_stdout, EndOfProcedure))
-                StdOutThread.setName("STDOUT-Redirector")
-                StdOutThread.setDaemon(False)
-                StdOutThread.start()
-            if Proc.stderr:
-                StdErrThread = threading.Thread(target=ReadMessage, args=(Proc.stderr, logger_stderr, EndOfProcedure))
-                StdErrThread.setName("STDERR-Redirector")
-                StdErrThread.setDaemon(False)
-                StdErrThread.start()
-            # waiting for program exit
-        Proc.wait()
-    except Exception:
-        raise
-
-    return_code = -1
-    if Proc:
-        if Proc.stdout and StdOutThread:
-            StdOutThread.join()
-        if Proc.stderr and StdErrThread:
-            StdErrThread.join()
-        return_code = Proc.returncode
-    cdpopd()
-    return return_code, stdout_buffer, stderr_buffer
+        if verbose:
+            # the output goes straight to the console; nothing is buffered.
+            Proc = subprocess.run(Command, stdout=sys.stdout, stderr=sys.stderr, env=os.environ, cwd=WorkingDir, shell=False)
+            r = Proc.returncode, [], []
+        else:
+            Proc = subprocess.run(Command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=os.environ, cwd=WorkingDir, shell=False)
+            r = (
+                Proc.returncode,
+                [line.rstrip() for line in Proc.stdout.decode('utf-8', errors='replace').splitlines()],
+                [line.rstrip() for line in Proc.stderr.decode('utf-8', errors='replace').splitlines()],
+            )
+    except OSError as e:
+        # e.g. the executable is not on PATH; 127 is what a shell would return.
+        r = 127, [], [str(e)]
+    return r
+
+
+def run_batch(cmd_groups, verbose=False):
+    """run the command groups, [(argv, working_dir, log), ...], in a single shell session.
+    A group is started only when its predecessor succeeds. When a group has a log
+    path, its output goes to that log, which is shown only when the group fails.
+    Returns as run() does."""
+    def quote(c):
+        """quote an argument for the shell"""
+        return subprocess.list2cmdline([c]) if os.name == 'nt' else shlex.quote(c)
+
+    cd = 'cd /d ' if os.name == 'nt' else 'cd '
+    steps = []
+    for cmds, working_dir, log in cmd_groups:
+        line = ' '.join(c if c == UDKBUILD_COMMAND_JOINTER else quote(c) for c in cmds)
+        if UDKBUILD_COMMAND_JOINTER in cmds:
+            line = '(%s)' % line
+        if log:
+            log = quote(_abspath(log))
+            if os.name == 'nt':
+                line = '(%s > %s 2>&1 || (type %s & exit 1))' % (line, log, log)
+            else:
+                line = '{ %s > %s 2>&1 || { rc=$?; cat %s >&2; exit $rc; }; }' % (line, log, log)
+        steps += ['%s%s && %s' % (cd, quote(_abspath(working_dir)), line)]
+    if os.name == 'nt':
+        # a string is passed to CreateProcess as-is; an argv list would get
+        # its quotes backslash-escaped, which cmd.exe does not understand.
+        return run('cmd.exe /c "%s"' % ' && '.join(steps), verbose=verbose)
+    return run(['/bin/sh', '-c', ' && '.join(steps)], verbose=verbose)
 
 
 def print_run_result(r, success_msg=''):
@@ -237,78 +263,87 @@ def print_run_result(r, success_msg=''):
 
 
 def locate_nasm():
-    """Try to locate the nasm's installation directory. For Windows only."""
-    for d in [
-            'C:\\Program Files\\NASM\nasm.exe',
-            'C:\\Program Files (x86)\\NASM\nasm.exe',
-            os.environ.get('LOCALAPPDATA', '') + '\\bin\\NASM\\nasm.exe',
-            'C:\\NASM\\nasm.exe',
-        ]:
-        if os.path.exists(d):
-            return os.path.dirname(d)
-    return ''
+    """Try to locate the nasm's installation directory. For Windows only.
+    The result is memoized in locate_nasm.nasm_dir."""
+    if locate_nasm.nasm_dir is None:
+        locate_nasm.nasm_dir = ''
+        for d in [
+                r'C:\Program Files\NASM\nasm.exe',
+                r'C:\Program Files (x86)\NASM\nasm.exe',
+                os.environ.get('LOCALAPPDATA', '') + r'\bin\NASM\nasm.exe',
+                r'C:\NASM\nasm.exe',
+            ]:
+            if os.path.exists(d):
+                locate_nasm.nasm_dir = os.path.dirname(d)
+                break
+    return locate_nasm.nasm_dir
+locate_nasm.nasm_dir = None
 
 
 def env_var(k, v):
     """Setup environment variable"""
+    env = os.environ
     k0 = k[0]
     k1 = k[1:]
     if v[0] == '$':             #marco from os.environ
-        v = os.environ.get(v[1:], '')
+        v = env.get(v[1:], '')
     if k0 in {'+', '*'}:
         try:
             ex = ''
             if k0 == '+':       #append
-                ex = '%s%s%s' % (os.environ[k1], os.pathsep, v)
+                ex = '%s%s%s' % (env[k1], os.pathsep, v)
             elif k0 == '*':     #prepend
-                ex = '%s%s%s' % (v, os.pathsep, os.environ[k1])
-            os.environ[k1] = ex
+                ex = '%s%s%s' % (v, os.pathsep, env[k1])
+            env[k1] = ex
         except KeyError:
-            os.environ[k1] = v
+            env[k1] = v
     elif k0 == '=':             # conditional assignment
-        if k1 not in os.environ:
-            os.environ[k1] = v
+        if k1 not in env:
+            env[k1] = v
     else:                       # unconditional assignment
-        os.environ[k] = v
+        env[k] = v
 
 
-def setup_env_vars(workspace, codetree):
+def setup_env_vars(workspace, udk_home, codetree):
     """Setup environment variables"""
-    env_var('=WORKSPACE', os.path.abspath(workspace))
-    udk_home = config.CODETREE["edk2"]['path']
-    env_var('=UDK_ABSOLUTE_DIR', os.path.abspath(udk_home))
-    env_var('=EDK_TOOLS_PATH', os.path.join(os.environ['UDK_ABSOLUTE_DIR'], 'BaseTools'))
-    env_var('=CONF_PATH', os.path.join(os.environ['WORKSPACE'], 'Conf'))
+    env = os.environ
+    ws_abs = _abspath(workspace)
+    udk_abs = _abspath(udk_home)
+    env_var('=WORKSPACE', ws_abs)
+    env_var('=UDK_ABSOLUTE_DIR', udk_abs)
+    env_var('=EDK_TOOLS_PATH', os.path.join(env['UDK_ABSOLUTE_DIR'], 'BaseTools'))
+    env_var('=CONF_PATH', os.path.join(env['WORKSPACE'], 'Conf'))
     env_var('=BASE_TOOLS_PATH', '$EDK_TOOLS_PATH')
-    env_var('=PYTHONPATH', os.path.join(os.environ['EDK_TOOLS_PATH'], 'Source', 'Python'))
-    env_var('=EDK_TOOLS_PATH_BIN', os.path.join(os.environ['EDK_TOOLS_PATH'], 'BinWrappers', "WindowsLike" if os.name == 'nt' else 'PosixLike'))
+    tools_path = env['EDK_TOOLS_PATH']
+    env_var('=PYTHONPATH', os.path.join(tools_path, 'Source', 'Python'))
+    env_var('=EDK_TOOLS_PATH_BIN', os.path.join(tools_path, 'BinWrappers', "WindowsLike" if os.name == 'nt' else 'PosixLike'))
 
     if os.name == 'nt':
-        env_var('*PATH', os.path.join(os.environ['EDK_TOOLS_PATH'], 'Bin', 'Win32'))
-        env_var('=PYTHON_HOME', os.path.dirname(sys.executable))
-        env_var('=PYTHONHOME', os.path.dirname(sys.executable))
+        py_home = os.path.dirname(sys.executable)
+        env_var('*PATH', os.path.join(tools_path, 'Bin', 'Win32'))
+        env_var('=PYTHON_HOME', py_home)
+        env_var('=PYTHONHOME', py_home)
         nasm_path = locate_nasm()
         if nasm_path:
             env_var('=NASM_PREFIX', nasm_path + os.sep)
     env_var('*PATH', '$EDK_TOOLS_PATH_BIN')
     env_var('+PACKAGES_PATH', '$UDK_ABSOLUTE_DIR')
-    env_var('+PACKAGES_PATH', os.path.abspath(".."))
+    env_var('+PACKAGES_PATH', _abspath(".."))
     for c in codetree:
         if c == 'edk2':
             continue
         if codetree[c].get('multiworkspace', False):
             env_var('+PACKAGES_PATH', codetree[c]["path"])
 
-    print('WORKSPACE      = %s' % os.environ['WORKSPACE'])
-    print('PACKAGES_PATH  = %s' % os.environ['PACKAGES_PATH'])
-    print('EDK_TOOLS_PATH = %s' % os.environ['EDK_TOOLS_PATH'])
-    print('CONF_PATH      = %s' % os.environ['CONF_PATH'])
+    print('WORKSPACE      = %s' % env['WORKSPACE'])
+    print('PACKAGES_PATH  = %s' % env['PACKAGES_PATH'])
+    print('EDK_TOOLS_PATH = %s' % tools_path)
+    print('CONF_PATH      = %s' % env['CONF_PATH'])
 
 
-def build_basetools(verbose=0):
-    """build the C-lang executables in Basetools.
-    Use: sys.argv[1]: "clean" """
-    home_dir = os.environ['EDK_TOOLS_PATH']
+def basetools_cmds(clean=False):
+    """the command to build the C-lang executables in Basetools.
+    clean: make the "clean" target instead."""
     cmds = [
         UDKBUILD_MAKETOOL,
     ]
@@ -316,32 +351,85 @@ def build_basetools(verbose=0):
         cmds += [
             '--jobs', '%d' % multiprocessing.cpu_count()
         ]
-    if 'cleanall' in sys.argv[1:]:
+    if clean:
         cmds += ['clean']
-    return run(cmds, home_dir, verbose=verbose)
+    return cmds
+
 
+def build_basetools(tools_path, clean=False, verbose=0):
+    """build the C-lang executables in Basetools."""
+    return run(basetools_cmds(clean), tools_path, verbose=verbose)
 
-def setup_codetree(codetree):
+
+def missing_submodules(local_dir, packages):
+    """return the paths of a git tree's submodules which lie in one of the
+    packages, e.g. "CryptoPkg", and are not checked out yet."""
+    try:
+        with open(os.path.join(local_dir, '.gitmodules'), 'r') as pf:
+            paths = [line.split('=', 1)[1].strip() for line in pf if line.strip().startswith('path')]
+    except FileNotFoundError:
+        return []
+    missing = []
+    for m in paths:
+        d = os.path.join(local_dir, m)
+        if m.split('/')[0] in packages and not (os.path.isdir(d) and os.listdir(d)):
+            missing += [m]
+    return missing
+
+
+def setup_codetree(codetree, shallow=True, packages=()):
     """pull the udk code tree when it does not locally/correctly exist.
-        1. git clone
-        2. git checkout tag/branch/master"""
+        1. git clone, or git fetch --depth=1 of the signature when shallow
+        2. git checkout tag/branch/master/commit
+        3. git submodule update of edk2, only for the missing submodules in
+           the packages used, which are not a node of their own in codetree"""
+    owned = {os.path.normcase(_abspath(codetree[c]["path"])) for c in codetree}
 
-    def _get_code(node):
+    def _get_code(node, packages=()):
         """get code using git clone/checkout"""
         local_dir = node["path"]
         dot_git = os.path.join(local_dir, '.git')
         url = node["source"]["url"]
         sig = node["source"]["signature"]
-        if not os.path.exists(local_dir):
-            os.makedirs(local_dir)
+        os.makedirs(local_dir, exist_ok=True)
 
-        if not os.path.exists(dot_git):
-            r = run(['git', 'clone', url, local_dir], local_dir, verbose=True)
+        fresh = not os.path.exists(dot_git)
+        if fresh:
+            if shallow:
+                r = run(['git', 'init', local_dir], local_dir, verbose=True)
+            else:
+                r = run(['git', 'clone', url, local_dir], local_dir, verbose=True)
             if r[0]:
                 return r
-        return run(['git', 'checkout', sig], local_dir, verbose=True)
+        # a tree without any commit is left by a failed or interrupted first fetch.
+        if shallow and (fresh or os.path.exists(os.path.join(dot_git, 'shallow'))
+                        or run(['git', 'rev-parse', '-q', '--verify', 'HEAD'], local_dir)[0]):
+            # fetch only the signature -- a branch, "tags/..." or a commit hash --
+            # into refs/pug/<signature>, which later runs check out locally.
+            ref = 'pug/%s' % sig
+            r = run(['git', 'checkout', ref], local_dir)
+            if r[0]:
+                # (re)point origin at the configured url, which may have been corrected.
+                r = run(['git', 'config', 'remote.origin.url', url], local_dir)
+                if not r[0]:
+                    r = run(['git', 'fetch', '--depth=1', 'origin', '+%s:refs/%s' % (sig, ref)], local_dir, verbose=True)
+                if not r[0]:
+                    r = run(['git', 'checkout', ref], local_dir, verbose=True)
+        else:
+            r = run(['git', 'checkout', sig], local_dir, verbose=True)
+        if r[0]:
+            return r
+        missing = [m for m in missing_submodules(local_dir, packages)
+                   if os.path.normcase(_abspath(os.path.join(local_dir, m))) not in owned]
+        if missing:
+            cmds = ['git', 'submodule', 'update', '--init']
+            if shallow:
+                cmds += ['--depth=1']
+            cmds += ['--jobs', '%d' % multiprocessing.cpu_count(), '--']
+            r = run(cmds + missing, local_dir, verbose=True)
+        return r
 
-    r0, r1, r2 = _get_code(codetree["edk2"])
+    r0, r1, r2 = _get_code(codetree["edk2"], packages)
     for c in codetree:
         if c == 'edk2':
             continue
@@ -360,58 +448,59 @@ def platform_dsc(platform, components, workspace):
     if not platform.get("update", False):
         return
     sections = ["Defines", "Components", "BuildOptions"]
-    overrides = {"LibraryClasses", "PcdsFixedAtBuild"} #, "BuildOptions"}
     pfile = []
     for s in sections:
         if s == 'Components':
-            pfile += gen_section(None, section=s)
+            pfile.extend(gen_section(None, section=s))
             for compc in components:
-                pfile += ['  %s' % compc["path"]]
-                in_override = False
-                ovs = overrides.intersection(set(compc.keys()))
+                ovs = [k for k in compc if k in DSC_OVERRIDES]
+                pfile.append('  %s {' % compc["path"] if ovs else '  %s' % compc["path"])
                 for ov in ovs:
                     #print("Override: %s" % ov)
-                    if not in_override:
-                        pfile[-1] += ' {'
-                        in_override = True
-                    pfile += ['    <%s>' % ov]
-                    sep = '|' if ov in {"LibraryClasses", "PcdsFixedAtBuild"} else '='
-                    for d in compc[ov]:
-                        if d and d[0]:
-                            pfile += ['      %s %s %s' % (d[0], sep, d[1])]
-                if in_override:
-                    pfile += ['  }']
+                    pfile.append('    <%s>' % ov)
+                    sep = '|' if ov in DSC_BAR_SEPARATED else '='
+                    pfile.extend('      %s %s %s' % (d[0], sep, d[1]) for d in compc[ov] if d and d[0])
+                if ovs:
+                    pfile.append('  }')
         else:
-            pfile += gen_section(platform[s], section=s)
+            pfile.extend(gen_section(platform[s], section=s))
     write_file(dsc_path, pfile, default_pug_signature)
 
 
+def _build_inf(comp, workspace):
+    """generate the INF content of a component.
+
+        returns
+        [0] - the INF path
+        [1] - the INF content, or None when the INF is not to be updated
+    """
+    inf_path = abs_path(comp.get('path', ""), workspace)
+    if not comp.get("update", False):
+        return inf_path, None
+    cfile = []
+    defines = comp.get('Defines', '')
+    if not defines:
+        raise Exception('INF must contain [Defines] section.')
+    cfile.extend(gen_section(defines, section='Defines'))
+    for s in comp:
+        s0 = s.split('.')[0]
+        if s0 not in INF_SECTIONS:
+            continue
+        #cfile += ['[%s]' % s]
+        if  s0 == 'LibraryClasses':
+            cfile.extend(gen_section([v[0] for v in comp[s] if v[0] != 'NULL'], section=s, override=list))
+        else:
+            cfile.extend(gen_section(comp[s], section=s))
+    return inf_path, cfile
+
+
 def component_inf(components, workspace):
     """generate INF files of components."""
-    sections = [
-        'Sources', 'Packages', 'LibraryClasses', 'Protocols', 'Ppis',
-        'Guids', 'FeaturePcd', 'Pcd', 'BuildOptions', 'Depex', 'UserExtensions',
-    ]
     for comp in components:
-        cfile = []
-        inf_path = abs_path(comp.get('path', ""), workspace)
+        inf_path, cfile = _build_inf(comp, workspace)
         print('COMPONENT: %s' % inf_path)
-        if not comp.get("update", False):
-            continue
-        defines = comp.get('Defines', '')
-        if not defines:
-            raise Exception('INF must contain [Defines] section.')
-        cfile += gen_section(defines, section='Defines')
-        for s in comp:
-            s0 = s.split('.')[0]
-            if s0 not in sections:
-                continue
-            #cfile += ['[%s]' % s]
-            if  s0 == 'LibraryClasses':
-                cfile += gen_section([v[0] for v in comp[s] if v[0] != 'NULL'], section=s, override=list)
-            else:
-                cfile += gen_section(comp[s], section=s)
-        write_file(inf_path, cfile, default_pug_signature)
+        if cfile is not None:
+            write_file(inf_path, cfile, default_pug_signature)
 
 
 def build():
@@ -420,45 +509,66 @@ def build():
        2. build C-lang executables in BaseTools.
        3. UDK build."""
 
-    workspace = os.path.abspath(config.WORKSPACE["path"])
-    udk_home = os.path.abspath(config.CODETREE["edk2"]["path"])
-
-    r = setup_codetree(config.CODETREE)
+    ws = config.WORKSPACE
+    codetree = config.CODETREE
+    components = config.COMPONENTS
+    workspace = _abspath(ws["path"])
+    udk_home = _abspath(codetree["edk2"]["path"])
+    conf_path = ws["conf_path"]
+    argv = sys.argv[1:]
+    clean = 'cleanall' in argv
+    build_stamp = os.path.join(ws["tmp_dir"], BUILD_STAMP_FILE)
+
+    packages = {p.split('/')[0] for comp in components for p in comp.get("Packages", [])}
+    r = setup_codetree(codetree, ws.get("shallow", True), packages)
     if r:
         print('Unable to setup the UDK code tree at: %s' % udk_home)
         print('Do you have the valid read-write access to that folder?')
         return r
 
-    setup_env_vars(workspace, config.CODETREE)
-    conf_files(['build_rule', 'tools_def', 'target'], config.WORKSPACE["conf_path"], VERBOSE_LEVEL > 1)
+    setup_env_vars(workspace, udk_home, codetree)
+    tools_path = os.environ['EDK_TOOLS_PATH']
+    ws_path = os.environ['WORKSPACE']
+    load_build_stamp(build_stamp)
+    conf_files(['build_rule', 'tools_def', 'target'], conf_path, VERBOSE_LEVEL > 1)
     gen_target_txt(config.TARGET_TXT)
 
-    r = print_run_result(build_basetools(verbose=(VERBOSE_LEVEL > 1)))
-    if r:
-        return r
-
-    platform_dsc(config.PLATFORM, config.COMPONENTS, workspace)
-    component_inf(config.COMPONENTS, workspace)
+    platform_dsc(config.PLATFORM, components, workspace)
+    component_inf(components, workspace)
+    save_build_stamp(build_stamp)
 
-    cmds = []
-    if os.name == 'nt':
-        cmds += [
-            os.path.join(os.environ['EDK_TOOLS_PATH'], 'set_vsprefix_envs.bat'), UDKBUILD_COMMAND_JOINTER,
-        ]
-    cmds += [
+    cmds = [
         'build',
         '-n', '%d' % multiprocessing.cpu_count(),
         '-N',
     ]
-    #report_log = config.WORKSPACE.get('report_log', '')
-    #log_type = config.WORKSPACE.get('log_type', '')
+    #report_log = ws.get('report_log', '')
+    #log_type = ws.get('log_type', '')
     #if report_log:
-    #    cmds += ["-y", config.WORKSPACE["report_log"]]
+    #    cmds += ["-y", ws["report_log"]]
     #if log_type:
     #    cmds += ["-Y %s" % s for s in log_type.split()]
 
-    cmds += sys.argv[1:]
-    r = run(cmds, os.environ['WORKSPACE'], verbose=VERBOSE_LEVEL)
+    cmds += argv
+    if os.name == 'nt':
+        # the .bat's settings must be visible to build.bat, so run both in one cmd.exe.
+        cmds = [os.path.join(tools_path, 'set_vsprefix_envs.bat'), UDKBUILD_COMMAND_JOINTER] + cmds
+
+    if VERBOSE_LEVEL <= 1:
+        # BaseTools and the UDK build share one shell session.
+        # BaseTools' output is kept in a log and shown only when it fails.
+        r = run_batch([
+            (basetools_cmds(clean), tools_path, os.path.join(ws["tmp_dir"], BASETOOLS_LOG_FILE)),
+            (cmds, ws_path, ''),
+        ], verbose=VERBOSE_LEVEL)
+        return print_run_result(r, 'Success.')
+
+    r = print_run_result(build_basetools(tools_path, clean, verbose=True))
+    if r:
+        return r
+    if os.name == 'nt':
+        cmds = ['cmd.exe', '/c'] + cmds
+    r = run(cmds, ws_path, verbose=VERBOSE_LEVEL)
     return print_run_result(r, 'Success.')
 
 